@@ -1,12 +1,112 @@
+import asyncio
+import os
 import re
-import time
-from typing import Optional, List
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, List
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-from fastapi import FastAPI, Body, Form, Query
+import anyio
+import orjson
+from cachetools import TTLCache
+
+from fastapi import FastAPI, Body, Form, HTTPException, Query
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
+from playwright.async_api import async_playwright, Error as PWError, TimeoutError as PWTimeout
+
+
+# --no-sandbox improves compatibility on many hosts; the rest trim
+# per-renderer memory and cap the V8 heap so one page can't OOM the container
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--no-zygote",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-accelerated-2d-canvas",
+    "--disable-partial-raster",
+    "--disable-mipmap-generation",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-sync",
+    "--disable-default-apps",
+    "--disable-translate",
+    "--mute-audio",
+    "--no-first-run",
+    # turns off site-per-process; passing --disable-features here would
+    # replace the list Playwright already sets instead of adding to it
+    "--disable-site-isolation-trials",
+    "--disable-blink-features=AutomationControlled",
+    "--js-flags=--max-old-space-size=512",
+]
+
+
+# Playwright keeps per-context bookkeeping on the Browser even after the
+# contexts close, so the shared browser is replaced after this many contexts.
+MAX_CONTEXTS_PER_BROWSER = int(os.environ.get("MAX_CONTEXTS_PER_BROWSER", "200"))
+
+
+async def _launch_browser(pw):
+    return await pw.chromium.launch(headless=True, args=CHROMIUM_ARGS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Launch Chromium once and reuse it across requests instead of paying
+    # the cold-start on every call.
+    pw = await async_playwright().start()
+    try:
+        app.state.playwright = pw
+        app.state.browser = await _launch_browser(pw)
+        app.state.browser_lock = asyncio.Lock()
+        app.state.contexts_served = 0
+        try:
+            yield
+        finally:
+            await app.state.browser.close()
+    finally:
+        await pw.stop()
+
 
-app = FastAPI(title="Transcribe.mov API")
+STREAM_PATH = "/transcribe/stream"
+
+
+class _GZipMiddleware(GZipMiddleware):
+    # gzip buffers small writes, which would hold back the NDJSON progress lines
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == STREAM_PATH:
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+
+app = FastAPI(
+    title="Transcribe.mov API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+# transcripts are plain prose and compress several times over
+app.add_middleware(_GZipMiddleware, minimum_size=1024)
+
+# caps how many isolated contexts share the Chromium process at once; pages
+# mostly sit idle on the network, so this is not tied to the CPU count
+MAX_CONTEXTS = int(os.environ.get("MAX_CONTEXTS", "8"))
+CONTEXT_SEMAPHORE = asyncio.Semaphore(MAX_CONTEXTS)
+
+# when every context is taken, callers get a 429 instead of queuing
+# behind transcriptions that can each run for minutes
+BUSY_RETRY_AFTER_SEC = 30
+
+# upper bound on closing a page/context once a request is done or cancelled
+CLEANUP_TIMEOUT_SEC = 10
+
+
+# finished transcripts by normalized media URL, and the in-flight ones
+TRANSCRIPT_CACHE: TTLCache = TTLCache(maxsize=256, ttl=24 * 3600)
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+# query params that only track the click and never change the media
+TRACKING_PARAMS = frozenset({"fbclid", "gclid", "igshid"})
 
 
 # ---------- MODELS ----------
@@ -16,156 +116,340 @@ class TranscribeReq(BaseModel):
 
 
 # ---------- HELPERS ----------
-def _extract_big_text(page) -> Optional[str]:
+APP_URL = "https://app.transcribe.mov/"
+
+TRANSCRIPT_TIMEOUT_MESSAGE = "Timed out waiting for transcript. Try longer max_wait_sec or verify link."
+
+# the result page lives at /transcript/<id>
+TRANSCRIPT_RE = re.compile(r"/transcript/")
+
+# the 'Download from anywhere' media URL input
+# one selector list, so the browser tries every variant in a single query
+URL_SELECTOR = ", ".join((
+    'input[placeholder^="https://"]',
+    "input[type=url]",
+    "input[placeholder*='https']",
+))
+
+BTN_SELECTORS = (
+    "button:has-text('Submit')",
+    "//button[contains(., 'Submit')]",
+)
+
+# nothing we read depends on these; stylesheets are kept because the
+# visibility checks behind fill/click rely on the page's layout
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "media", "font"})
+
+# analytics/ads beacons; matched against the request host and its parents
+BLOCKED_HOSTS = frozenset({
+    "doubleclick.net",
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googlesyndication.com",
+    "facebook.net",
+    "hotjar.com",
+    "segment.io",
+    "clarity.ms",
+})
+
+# where the final transcript block may live, most specific first
+CANDIDATE_SELECTORS = (
+    "div.prose",
+    "div[class*='prose']",
+    "div[class*='transcript']",
+    "div[id*='transcript']",
+    "article",
+    "main",
+    "div.content, div.container, div.markdown",
+)
+
+# more words than this, so the 'Started...' message isn't taken for a transcript
+MIN_TRANSCRIPT_WORDS = 100
+
+# Returns the first candidate block with enough words, falling back to the
+# visible paragraphs.
+EXTRACT_TRANSCRIPT_JS = """
+([selectors, minWords]) => {
+    const bigEnough = (t) => t && t.split(/\\s+/).length > minWords;
+    for (const sel of selectors) {
+        const el = document.querySelector(sel);
+        if (!el) continue;
+        const txt = el.innerText.trim();
+        if (bigEnough(txt)) return txt;
+    }
+    const txt = Array.from(document.querySelectorAll("main p, article p, div p"))
+        .map((p) => p.innerText.trim())
+        .filter(Boolean)
+        .join("\\n\\n");
+    return bigEnough(txt) ? txt : null;
+}
+"""
+
+
+def _is_blocked_host(url: str) -> bool:
+    host = urlsplit(url).hostname or ""
+    parts = host.split(".")
+    return any(".".join(parts[i:]) in BLOCKED_HOSTS for i in range(len(parts) - 1))
+
+
+async def _block_heavy_resources(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or _is_blocked_host(request.url):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def _wait_for_transcript(page, timeout_ms: float) -> Optional[str]:
     """
-    Try several selectors to pull the final transcript block.
-    Returns the text or None if not found / too small.
+    Wait until one of the selectors holds the final transcript block.
+    Returns the text or None if it did not show up within timeout_ms.
     """
-    candidate_selectors = [
-        "div.prose",
-        "div[class*='prose']",
-        "div[class*='transcript']",
-        "div[id*='transcript']",
-        "article",
-        "main",
-        "div.content, div.container, div.markdown",
-    ]
-    for sel in candidate_selectors:
-        try:
-            el = page.query_selector(sel)
-            if not el:
-                continue
-            txt = el.inner_text().strip()
-            # require enough words to avoid returning the 'Started...' message
-            if txt and len(txt.split()) > 100:
-                return txt
-        except Exception:
-            continue
-
-    # fallback: collect visible paragraphs
     try:
-        paras = page.query_selector_all("main p, article p, div p")
-        txt = "\n\n".join([p.inner_text().strip() for p in paras if p.inner_text().strip()])
-        return txt if len(txt.split()) > 100 else None
-    except Exception:
+        # the probe runs in-page, so re-checking costs no driver round-trips
+        handle = await page.wait_for_function(
+            EXTRACT_TRANSCRIPT_JS,
+            arg=[list(CANDIDATE_SELECTORS), MIN_TRANSCRIPT_WORDS],
+            polling=500,
+            # a timeout of 0 would mean "wait forever"
+            timeout=max(timeout_ms, 1),
+        )
+        return await handle.json_value()
+    except PWError:
         return None
 
 
-def _run_transcription(url: str, max_wait_sec: int, phase_log: List[str]):
-    with sync_playwright() as p:
-        # --no-sandbox improves compatibility on many hosts
-        browser = p.chromium.launch(headless=True, args=["--no-sandbox"])
-        context = browser.new_context()
-        page = context.new_page()
-
-        # Step 1: Open the app
-        phase_log.append("open_app")
-        page.goto("https://app.transcribe.mov/", wait_until="load")
-
-        # Step 2: Fill the media URL (the 'Download from anywhere' input)
-        phase_log.append("fill_url")
-        filled = False
-        selectors = [
-            'input[placeholder^="https://"]',
-            "input[type=url]",
-            "input[placeholder*='https']",
-        ]
-        for sel in selectors:
-            el = page.query_selector(sel)
-            if el:
-                el.fill(url)
-                filled = True
-                break
-        if not filled:
-            # fallback: locate by section heading
-            try:
-                section = page.locator("text=Download from anywhere").first
-                inp = section.locator("xpath=..").locator("input").first
-                inp.fill(url)
-                filled = True
-            except Exception:
-                pass
-
-        if not filled:
-            browser.close()
-            return {
+async def _new_context():
+    """
+    Open a context on the shared browser, swapping in a fresh browser once
+    the current one has served MAX_CONTEXTS_PER_BROWSER contexts.
+    """
+    async with app.state.browser_lock:
+        if app.state.contexts_served >= MAX_CONTEXTS_PER_BROWSER:
+            retired = app.state.browser
+            app.state.browser = await _launch_browser(app.state.playwright)
+            app.state.contexts_served = 0
+            # otherwise the last in-flight context closes it on release
+            if not retired.contexts:
+                await retired.close()
+        app.state.contexts_served += 1
+        # service workers would fetch outside context.route and pin extra memory
+        return await app.state.browser.new_context(service_workers="block")
+
+
+async def _release_context(context):
+    browser = context.browser
+    try:
+        await context.close()
+    finally:
+        if browser is not app.state.browser and not browser.contexts:
+            await browser.close()
+
+
+def _busy_error() -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="All browser contexts are busy. Try again later.",
+        headers={"Retry-After": str(BUSY_RETRY_AFTER_SEC)},
+    )
+
+
+def _normalize_url(url: str) -> str:
+    """Cache key for a media URL: lowercase scheme/host, no fragment or tracking params."""
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        # e.g. an unbalanced IPv6 host; let the page report the bad link
+        return url
+    query = [
+        (k, v)
+        for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.startswith("utm_") and k not in TRACKING_PARAMS
+    ]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+
+async def _transcription_events(url: str, max_wait_sec: int) -> AsyncIterator[dict]:
+    """
+    Yield {"phase": ...} progress events, then the final result dict.
+    Successful results are cached per normalized URL, and concurrent
+    requests for the same URL wait (up to their own max_wait_sec) for the
+    first one and share its transcript instead of transcribing it again.
+    """
+    key = _normalize_url(url)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait_sec
+    while True:
+        cached = TRANSCRIPT_CACHE.get(key)
+        if cached is not None:
+            yield {"phase": "cache_hit"}
+            yield {**cached, "source_url": url}
+            return
+        inflight = _INFLIGHT.get(key)
+        if inflight is None:
+            break
+        yield {"phase": "await_inflight"}
+        try:
+            # shielded so a waiter going away doesn't affect the owner
+            result = await asyncio.wait_for(asyncio.shield(inflight), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            yield {
                 "status": "error",
-                "message": "Could not find the URL input on the page.",
-                "phase_log": phase_log,
+                "message": TRANSCRIPT_TIMEOUT_MESSAGE,
             }
+            return
+        if result is not None and result.get("status") == "ok":
+            yield {**result, "source_url": url}
+            return
+        # the owner failed or went away; its errors can come from its own
+        # settings (e.g. a shorter max_wait_sec), so run it ourselves with
+        # the time we have left
+        max_wait_sec = max(int(deadline - loop.time()), 0)
 
-        # Step 3: Click the Submit button
-        phase_log.append("click_submit")
-        clicked = False
-        btn_selectors = [
-            "button:has-text('Submit')",
-            "//button[contains(., 'Submit')]",
-        ]
-        for bsel in btn_selectors:
+    done = loop.create_future()
+    _INFLIGHT[key] = done
+    result = None
+    try:
+        async for event in _browser_transcription_events(url, max_wait_sec):
+            if "phase" not in event:
+                result = event
+                if event.get("status") == "ok":
+                    TRANSCRIPT_CACHE[key] = dict(event)
+            yield event
+    finally:
+        del _INFLIGHT[key]
+        done.set_result(result)
+
+
+async def _browser_transcription_events(url: str, max_wait_sec: int) -> AsyncIterator[dict]:
+    """
+    Run the transcription in its own browser context.
+    Closing the generator early tears the context down.
+    """
+    if CONTEXT_SEMAPHORE.locked():
+        raise _busy_error()
+    async with CONTEXT_SEMAPHORE:
+        # the browser is shared; each request gets its own isolated context
+        context = await _new_context()
+        try:
+            # registered once per context, so it goes away with it
+            await context.route("**/*", _block_heavy_resources)
+            page = await context.new_page()
             try:
-                page.click(bsel, timeout=3000)
-                clicked = True
-                break
-            except Exception:
-                continue
-        if not clicked:
-            browser.close()
-            return {
-                "status": "error",
-                "message": "Could not click the Submit button.",
-                "phase_log": phase_log,
-            }
+                async for event in _drive_transcription(page, url, max_wait_sec):
+                    yield event
+            finally:
+                # a dropped stream cancels the whole task-group scope, which
+                # would cancel these closes too and leak the context; the
+                # deadline keeps a hung renderer from pinning the slot
+                with anyio.move_on_after(CLEANUP_TIMEOUT_SEC, shield=True):
+                    await page.close()
+        finally:
+            with anyio.move_on_after(CLEANUP_TIMEOUT_SEC, shield=True):
+                await _release_context(context)
+
+
+async def _run_transcription(url: str, max_wait_sec: int, phase_log: List[str]):
+    result: dict = {}
+    async for event in _transcription_events(url, max_wait_sec):
+        if "phase" in event:
+            phase_log.append(event["phase"])
+        else:
+            result = event
+    return {**result, "phase_log": phase_log}
+
 
-        # Step 4: Wait for result page (/transcript/<id>)
-        phase_log.append("wait_result_route")
+async def _stream_transcription(url: str, max_wait_sec: int) -> AsyncIterator[bytes]:
+    try:
+        async for event in _transcription_events(url, max_wait_sec):
+            yield orjson.dumps(event) + b"\n"
+    # the 200 status line is already sent, so report failures in-band
+    except HTTPException as exc:
+        yield orjson.dumps({"status": "error", "message": exc.detail}) + b"\n"
+    except PWError as exc:
+        yield orjson.dumps({"status": "error", "message": exc.message}) + b"\n"
+
+
+async def _drive_transcription(page, url: str, max_wait_sec: int) -> AsyncIterator[dict]:
+    # Step 1: Open the app
+    yield {"phase": "open_app"}
+    # don't wait for the full load; the input wait below is what matters
+    await page.goto(APP_URL, wait_until="commit")
+
+    # Step 2: Fill the media URL (the 'Download from anywhere' input)
+    yield {"phase": "fill_url"}
+    filled = False
+    try:
+        el = await page.wait_for_selector(URL_SELECTOR, timeout=30_000)
+    except PWTimeout:
+        el = None
+    if el:
+        await el.fill(url)
+        filled = True
+    if not filled:
+        # fallback: locate by section heading
         try:
-            page.wait_for_url(re.compile(r"/transcript/"), timeout=120_000)
-        except PWTimeout:
-            browser.close()
-            return {
-                "status": "error",
-                "message": "Did not navigate to /transcript/ page. Maybe bad link or rate limit.",
-                "phase_log": phase_log,
-            }
+            section = page.locator("text=Download from anywhere").first
+            inp = section.locator("xpath=..").locator("input").first
+            await inp.fill(url)
+            filled = True
+        except PWError:
+            pass
 
-        # Step 5: Poll until 'Transcription completed' and a large transcript is present
-        phase_log.append("poll_until_complete")
-        deadline = time.time() + max_wait_sec
-        transcript_text: Optional[str] = None
-        completed_banner_seen = False
-
-        while time.time() < deadline:
-            # 5.a Wait for explicit completion banner (if present)
-            if not completed_banner_seen:
-                try:
-                    page.wait_for_selector("text=Transcription completed", timeout=5_000)
-                    completed_banner_seen = True
-                except PWTimeout:
-                    pass
-
-            # 5.b Try to extract a big block of text
-            if completed_banner_seen:
-                transcript_text = _extract_big_text(page)
-                if transcript_text:
-                    break
-
-            page.wait_for_timeout(1500)  # small idle wait
-
-        browser.close()
-
-        if not transcript_text:
-            return {
-                "status": "error",
-                "message": "Timed out waiting for transcript. Try longer max_wait_sec or verify link.",
-                "phase_log": phase_log,
-            }
+    if not filled:
+        yield {
+            "status": "error",
+            "message": "Could not find the URL input on the page.",
+        }
+        return
 
-        return {
-            "status": "ok",
-            "source_url": url,
-            "transcript": transcript_text,
-            "phase_log": phase_log,
+    # Step 3: Click the Submit button
+    yield {"phase": "click_submit"}
+    clicked = False
+    for bsel in BTN_SELECTORS:
+        try:
+            await page.click(bsel, timeout=3000)
+            clicked = True
+            break
+        except PWError:
+            continue
+    if not clicked:
+        yield {
+            "status": "error",
+            "message": "Could not click the Submit button.",
         }
+        return
+
+    # Step 4: Wait for result page (/transcript/<id>)
+    yield {"phase": "wait_result_route"}
+    try:
+        await page.wait_for_url(TRANSCRIPT_RE, timeout=120_000)
+    except PWTimeout:
+        yield {
+            "status": "error",
+            "message": "Did not navigate to /transcript/ page. Maybe bad link or rate limit.",
+        }
+        return
+
+    # Step 5: Wait until a large transcript is present. The completion banner
+    # isn't required: it doesn't always render, and EXTRACT_TRANSCRIPT_JS
+    # already rejects the short 'Started...' message.
+    yield {"phase": "poll_until_complete"}
+    transcript_text = await _wait_for_transcript(page, max_wait_sec * 1000)
+
+    if not transcript_text:
+        yield {
+            "status": "error",
+            "message": TRANSCRIPT_TIMEOUT_MESSAGE,
+        }
+        return
+
+    yield {
+        "status": "ok",
+        "source_url": url,
+        "transcript": transcript_text,
+    }
 
 
 # ---------- ROUTES ----------
@@ -173,7 +457,7 @@ def _run_transcription(url: str, max_wait_sec: int, phase_log: List[str]):
 def root():
     return {
         "status": "ok",
-        "message": "Use POST /transcribe (JSON), POST /transcribe-form (form), GET /transcribe_q (query) or open /docs",
+        "message": "Use POST /transcribe (JSON), POST /transcribe/stream (NDJSON), POST /transcribe-form (form), GET /transcribe_q (query) or open /docs",
     }
 
 
@@ -184,26 +468,40 @@ def health():
 
 # JSON endpoint
 @app.post("/transcribe")
-def transcribe(req: TranscribeReq = Body(...)):
+async def transcribe(req: TranscribeReq = Body(...)):
     phase_log: List[str] = []
-    return _run_transcription(req.url, req.max_wait_sec, phase_log)
+    return await _run_transcription(req.url, req.max_wait_sec, phase_log)
+
+
+# NDJSON endpoint: one line per phase, then the result line. Disconnecting
+# cancels the transcription and frees its browser context.
+@app.post(STREAM_PATH)
+async def transcribe_stream(req: TranscribeReq = Body(...)):
+    # check before the 200 goes out; cached and in-flight URLs need no context
+    key = _normalize_url(req.url)
+    if key not in TRANSCRIPT_CACHE and key not in _INFLIGHT and CONTEXT_SEMAPHORE.locked():
+        raise _busy_error()
+    return StreamingResponse(
+        _stream_transcription(req.url, req.max_wait_sec),
+        media_type="application/x-ndjson",
+    )
 
 
 # Form endpoint (handy for n8n 'Form-URL Encoded')
 @app.post("/transcribe-form")
-def transcribe_form(
+async def transcribe_form(
     url: str = Form(...),
     max_wait_sec: int = Form(600),
 ):
     phase_log: List[str] = []
-    return _run_transcription(url, max_wait_sec, phase_log)
+    return await _run_transcription(url, max_wait_sec, phase_log)
 
 
 # GET endpoint (quick testing from a browser)
 @app.get("/transcribe_q")
-def transcribe_q(
+async def transcribe_q(
     url: str = Query(...),
     max_wait_sec: int = Query(600),
 ):
     phase_log: List[str] = []
-    return _run_transcription(url, max_wait_sec, phase_log)
+    return await _run_transcription(url, max_wait_sec, phase_log)
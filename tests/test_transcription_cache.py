@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def _clean_state():
+    main.TRANSCRIPT_CACHE.clear()
+    main._INFLIGHT.clear()
+    yield
+    main.TRANSCRIPT_CACHE.clear()
+    main._INFLIGHT.clear()
+
+
+def _fake_browser(monkeypatch, results, delay=0.05):
+    """Replace the browser run with one that returns `results` in order."""
+    calls = []
+
+    async def fake(url, max_wait_sec):
+        calls.append((url, max_wait_sec))
+        yield {"phase": "open_app"}
+        await asyncio.sleep(delay)
+        yield dict(results[len(calls) - 1], source_url=url)
+
+    monkeypatch.setattr(main, "_browser_transcription_events", fake)
+    return calls
+
+
+async def _final(url, max_wait_sec=600):
+    events = [e async for e in main._transcription_events(url, max_wait_sec)]
+    return events[-1]
+
+
+# ---------- _normalize_url ----------
+def test_normalize_url_drops_tracking_and_fragment():
+    url = " HTTPS://WWW.YouTube.com/watch?v=abc&utm_source=x&fbclid=1&t=5#frag "
+    assert main._normalize_url(url) == "https://www.youtube.com/watch?v=abc&t=5"
+
+
+def test_normalize_url_keeps_path_case():
+    assert main._normalize_url("https://x.com/AbC") == "https://x.com/AbC"
+
+
+def test_normalize_url_falls_back_on_malformed_url():
+    assert main._normalize_url("  http://[::1 ") == "http://[::1"
+
+
+# ---------- cache / in-flight coalescing ----------
+def test_cache_hit_skips_browser(monkeypatch):
+    calls = _fake_browser(monkeypatch, [{"status": "ok", "transcript": "t"}])
+
+    async def run():
+        await _final("https://a.com/v?utm_source=x")
+        return await _final("https://A.com/v")
+
+    result = asyncio.run(run())
+    assert len(calls) == 1
+    assert result == {"status": "ok", "transcript": "t", "source_url": "https://A.com/v"}
+
+
+def test_waiter_shares_owner_success(monkeypatch):
+    calls = _fake_browser(monkeypatch, [{"status": "ok", "transcript": "t"}])
+
+    async def run():
+        return await asyncio.gather(_final("https://a.com/v"), _final("https://a.com/v#x"))
+
+    owner, waiter = asyncio.run(run())
+    assert len(calls) == 1
+    assert owner["status"] == waiter["status"] == "ok"
+    assert waiter["source_url"] == "https://a.com/v#x"
+
+
+def test_waiter_takes_over_after_owner_error(monkeypatch):
+    calls = _fake_browser(monkeypatch, [
+        {"status": "error", "message": main.TRANSCRIPT_TIMEOUT_MESSAGE},
+        {"status": "ok", "transcript": "t"},
+    ])
+
+    async def run():
+        return await asyncio.gather(_final("https://a.com/v", 10), _final("https://a.com/v", 600))
+
+    owner, waiter = asyncio.run(run())
+    assert len(calls) == 2
+    assert owner["status"] == "error"
+    assert waiter["status"] == "ok"
+    # the take-over only gets what is left of the waiter's own budget
+    assert 0 < calls[1][1] <= 600
+
+
+def test_waiter_wait_is_bounded_by_its_own_max_wait(monkeypatch):
+    _fake_browser(monkeypatch, [{"status": "ok", "transcript": "t"}], delay=5)
+
+    async def run():
+        owner = asyncio.create_task(_final("https://a.com/v"))
+        await asyncio.sleep(0)
+        try:
+            return await asyncio.wait_for(_final("https://a.com/v", 0), 1)
+        finally:
+            owner.cancel()
+
+    result = asyncio.run(run())
+    assert result == {"status": "error", "message": main.TRANSCRIPT_TIMEOUT_MESSAGE}